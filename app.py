@@ -1,7 +1,9 @@
-import time, math, os
+import math, os, io, hashlib, bisect, itertools
 import streamlit as st
+import numpy as np
 import pandas as pd
 import pydeck as pdk
+from geo import haversine_km_from_home
 
 st.set_page_config(page_title="Nearest Safe Shelter — Vyshhorod", layout="wide")
 
@@ -13,42 +15,163 @@ TICK_SECONDS = 1.0                     # refresh cadence
 
 # ALERT/SAFE pattern in seconds (loops forever)
 PATTERN = [("ALERT", 120), ("SAFE", 60), ("ALERT", 45), ("SAFE", 90)]
+_STATES = [s for s, _ in PATTERN]
+_DURS = [d for _, d in PATTERN]
+_CUM = list(itertools.accumulate(_DURS))  # end offset of each phase
+PATTERN_LENGTH = _CUM[-1]
 
 # If this CSV exists next to app.py, it will be loaded automatically
 SHELTER_CSV = "shelters_vyshhorod.csv"  # columns: name,lat,lon[,type,capacity]
+CSV_DTYPES = {"name": str, "lat": "float64", "lon": "float64", "type": str}  # capacity: coerced after parsing
 
 # ----------------------------
 # Helpers
 # ----------------------------
-def haversine_km(lat1, lon1, lat2, lon2):
-    R = 6371.0
-    p1, p2 = math.radians(lat1), math.radians(lat2)
-    dphi = math.radians(lat2 - lat1)
-    dlmb = math.radians(lon2 - lon1)
-    a = math.sin(dphi/2)**2 + math.cos(p1)*math.cos(p2)*math.sin(dlmb/2)**2
-    return 2*R*math.asin(math.sqrt(a))
+def equirect_km(lat0, lon0, lats_ideg, lons_ideg):
+    """Equirectangular approximation of haversine_km_from_home over int32 micro-degree arrays; fine at city scale."""
+    ky = 6371.0 * math.pi / 180 * 1e-6   # km per micro-degree on the same sphere as haversine
+    kx = ky * math.cos(math.radians(lat0))
+    # Inputs are bounded to |lat|<=90, |lon|<=180 (rows outside are dropped), so |diff| <= 3.6e8 < 2**31
+    dx = (lons_ideg - np.int32(round(lon0 * 1e6))).astype(np.float32) * np.float32(kx)
+    dy = (lats_ideg - np.int32(round(lat0 * 1e6))).astype(np.float32) * np.float32(ky)
+    return np.hypot(dx, dy)
+
+def nearest_idx(dists, radius_km, k=2):
+    """Indices of the k closest shelters within radius (or overall if none), nearest first."""
+    pool = np.flatnonzero(dists <= radius_km)
+    if pool.size == 0:
+        pool = np.arange(dists.size)
+    k = min(k, pool.size)
+    if k == 0:
+        return pool
+    idx = pool[np.argpartition(dists[pool], k - 1)[:k]]
+    return idx[np.argsort(dists[idx], kind="stable")]
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def nearest_shelters(home_lat, home_lon, radius_km, shelters_key, _lats_ideg, _lons_ideg):
+    """Return (indices, dist_km, eta_min) of the two nearest shelters.
+
+    Cached on (home, radius, shelters_key) so clock-only reruns skip the search;
+    the coordinate arrays are identified by shelters_key, not hashed.
+    """
+    # Rank on the cheap approximation; exact (scalar) haversine only for the winners
+    idx = nearest_idx(equirect_km(home_lat, home_lon, _lats_ideg, _lons_ideg), radius_km)
+    p1 = math.radians(home_lat)
+    home = (p1, math.cos(p1), math.radians(home_lon))
+    dists = np.array([haversine_km_from_home(*home, _lats_ideg[i] * 1e-6, _lons_ideg[i] * 1e-6)
+                      for i in idx])
+    etas = np.maximum(1, np.rint(dists * 12)).astype(np.int32)  # walk ~5 km/h
+    return idx, dists, etas
+
+@st.cache_resource(max_entries=16, show_spinner=False)
+def shelter_layer_for(shelters_key, _shelters):
+    """Static scatter layer of all shelters; rebuilt only when the shelter set changes."""
+    return pdk.Layer(
+        "ScatterplotLayer",
+        data=_shelters[["name","lat","lon"]].to_dict("records"),
+        get_position='[lon, lat]',
+        get_radius=50,
+        get_fill_color='[30, 120, 200]',
+        pickable=True,
+    )
+
+@st.cache_resource(show_spinner=False)
+def focus_ring_for(radius_km):
+    """Focus ring around the town centre; depends only on the radius slider."""
+    return pdk.Layer(
+        "ScatterplotLayer",
+        data=[{"lat": HOME_LAT, "lon": HOME_LON, "name":"Vyshhorod"}],
+        get_position='[lon, lat]',
+        get_radius=int(radius_km*320),  # rough visual radius
+        get_fill_color='[30,160,60,30]',
+        pickable=False,
+    )
 
-def pattern_length():
-    return sum(d for _, d in PATTERN)
+def session_deck(home_lat, home_lon, top_ids, is_alert, radius_km, top2):
+    """This session's map Deck; its layers are swapped in place only when the visual state changes."""
+    key = (home_lat, home_lon, top_ids, is_alert, radius_km, ss.shelters_key)
+    if ss.get("deck_key") == key:
+        return ss.deck
+
+    # Layers: home, highlights, paths are built here; shelters and focus ring have their own caches
+    home_layer = pdk.Layer(
+        "ScatterplotLayer",
+        data=[{"name":"You","lat":home_lat,"lon":home_lon}],
+        get_position='[lon, lat]',
+        get_radius=60,
+        get_fill_color='[200, 30, 30]' if is_alert else '[30, 160, 60]',
+        pickable=True,
+    )
+
+    shelter_layer = shelter_layer_for(ss.shelters_key, ss.shelters)
+
+    highlight_layer = pdk.Layer(
+        "ScatterplotLayer",
+        data=top2[["name","lat","lon"]].to_dict("records"),
+        get_position='[lon, lat]',
+        get_radius=85,
+        get_fill_color='[240, 180, 0]',
+        pickable=True,
+    )
+
+    paths = [{"path":[[home_lon, home_lat],[lon, lat]], "name":f"→ {name}"}
+             for lon, lat, name in zip(top2["lon"].tolist(), top2["lat"].tolist(), top2["name"].tolist())]
+    path_layer = pdk.Layer(
+        "PathLayer",
+        data=paths,
+        get_path="path",
+        width_scale=2,
+        get_width=5,
+        get_color=[255, 140, 0] if is_alert else [120,120,120],
+        pickable=True,
+    )
+
+    focus_ring = focus_ring_for(radius_km)
+
+    layers = [focus_ring, shelter_layer, highlight_layer, path_layer, home_layer]
+    if "deck" in ss:
+        ss.deck.layers[:] = layers
+    else:
+        ss.deck = pdk.Deck(
+            map_provider="carto",      # <= free tiles, no token needed
+            map_style="dark",
+            initial_view_state=pdk.ViewState(latitude=HOME_LAT, longitude=HOME_LON, zoom=12.2),
+            layers=layers,
+            tooltip={"text": "{name}"},
+        )
+    ss.deck_key = key
+    return ss.deck
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def plan_blobs(home_lat, home_lon, top_ids, shelters_key, _top2):
+    """Tick-independent parts of "My Plan": (numbered TXT rows, CSV bytes)."""
+    rows = _top2[["name","dist_km","eta_min"]].itertuples(index=False, name=None)
+    txt_rows = "\n".join(f"{i}. {name} — {dist_km:.2f} km (~{eta_min} min)"
+                          for i, (name, dist_km, eta_min) in enumerate(rows, start=1))
+    csv_bytes = _top2[["name","lat","lon","dist_km","eta_min"] + [c for c in ["type","capacity"] if c in _top2.columns]] \
+                    .to_csv(index=False).encode("utf-8")
+    return txt_rows, csv_bytes
 
 def state_at(t):
     """Return (state, elapsed_in_state, remaining_in_state) for t seconds into the loop."""
-    t_mod = t % pattern_length()
-    cum = 0
-    for state, dur in PATTERN:
-        if t_mod < cum + dur:
-            elapsed = t_mod - cum
-            remain = dur - elapsed
-            return state, int(elapsed), int(remain)
-        cum += dur
-    return "SAFE", 0, PATTERN[1][1]
-
-def load_shelters_from_csv(file_or_path) -> pd.DataFrame:
-    df = pd.read_csv(file_or_path)
-    if not {"name","lat","lon"}.issubset(df.columns):
+    t_mod = t % PATTERN_LENGTH
+    i = bisect.bisect_right(_CUM, t_mod)
+    elapsed = t_mod - (_CUM[i-1] if i else 0)
+    return _STATES[i], int(elapsed), int(_DURS[i] - elapsed)
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def load_shelters_from_csv(csv_bytes: bytes) -> pd.DataFrame:
+    header = pd.read_csv(io.BytesIO(csv_bytes), nrows=0).columns
+    if not {"name","lat","lon"}.issubset(header):
         raise ValueError("CSV must have columns: name, lat, lon (optionally: type, capacity)")
-    cols = ["name","lat","lon"] + [c for c in ["type","capacity"] if c in df.columns]
-    return df[cols].copy()
+    cols = ["name","lat","lon"] + [c for c in ["type","capacity"] if c in header]
+    df = pd.read_csv(io.BytesIO(csv_bytes), usecols=cols,
+                     dtype={c: CSV_DTYPES[c] for c in cols if c in CSV_DTYPES})
+    if "capacity" in cols:
+        # Odd cells (12.5, "n/a", huge numbers) become whole numbers or blanks, never a rejected file
+        cap = np.trunc(pd.to_numeric(df["capacity"], errors="coerce"))
+        df["capacity"] = cap.where(cap.abs() < 2**31).astype("Int32")
+    return df[cols]
 
 def load_default_shelters() -> pd.DataFrame:
     data = [
@@ -65,19 +188,45 @@ def load_default_shelters() -> pd.DataFrame:
     ]
     return pd.DataFrame(data)
 
+def extra_text(df: pd.DataFrame) -> list:
+    """Per-row " • type • cap N" suffix for the shelter list; missing values are skipped."""
+    extra = pd.Series("", index=df.index)
+    if "type" in df.columns:
+        extra += (" • " + df["type"].astype(str)).where(df["type"].notna(), "")
+    if "capacity" in df.columns:
+        cap = df["capacity"]
+        extra += (" • cap " + cap.fillna(0).astype(int).astype(str)).where(cap.notna(), "")
+    return extra.tolist()
+
 # ----------------------------
 # Session state
 # ----------------------------
 ss = st.session_state
+
+def set_shelters(df: pd.DataFrame):
+    """Store the shelter table (rows with missing/out-of-range coordinates dropped) and int32 micro-degree lat/lon arrays."""
+    lats, lons = df["lat"].to_numpy(dtype=np.float64), df["lon"].to_numpy(dtype=np.float64)
+    ok = (np.abs(lats) <= 90) & (np.abs(lons) <= 180)  # also False for NaN
+    if not ok.all():  # rows without usable coordinates can never be the nearest; drop them
+        df, lats, lons = df[ok].reset_index(drop=True), lats[ok], lons[ok]
+    ss.shelters_dropped = int((~ok).sum())
+    lat_ideg = np.rint(lats * 1e6).astype(np.int32)  # ~0.1 m resolution, 4 bytes per coordinate
+    lon_ideg = np.rint(lons * 1e6).astype(np.int32)
+    ss.shelters, ss.shelter_lat_ideg, ss.shelter_lon_ideg = df, lat_ideg, lon_ideg
+    # Key covers every column (type/capacity included): cached plan CSVs and layers are shared across sessions
+    row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    ss.shelters_key = hashlib.sha1("\x00".join(df.columns).encode("utf-8") + row_hashes.tobytes()).hexdigest()
+
 if "running"   not in ss: ss.running = True
 if "tick"      not in ss: ss.tick = 0
 if "home_lat"  not in ss: ss.home_lat = HOME_LAT
 if "home_lon"  not in ss: ss.home_lon = HOME_LON
 if "shelters"  not in ss:
     if os.path.exists(SHELTER_CSV):
-        ss.shelters = load_shelters_from_csv(SHELTER_CSV)
+        with open(SHELTER_CSV, "rb") as f:
+            set_shelters(load_shelters_from_csv(f.read()))
     else:
-        ss.shelters = load_default_shelters()
+        set_shelters(load_default_shelters())
 
 # ----------------------------
 # Sidebar
@@ -86,8 +235,8 @@ st.sidebar.title("Vyshhorod Shelter Controls")
 
 with st.sidebar.expander("Your location (Vyshhorod by default)", expanded=True):
     col_l1, col_l2 = st.columns(2)
-    ss.home_lat = col_l1.number_input("Latitude", value=float(ss.home_lat), step=0.0005, format="%.6f")
-    ss.home_lon = col_l2.number_input("Longitude", value=float(ss.home_lon), step=0.0005, format="%.6f")
+    ss.home_lat = col_l1.number_input("Latitude", value=float(ss.home_lat), min_value=-90.0, max_value=90.0, step=0.0005, format="%.6f")
+    ss.home_lon = col_l2.number_input("Longitude", value=float(ss.home_lon), min_value=-180.0, max_value=180.0, step=0.0005, format="%.6f")
     if st.button("Reset to Vyshhorod"):
         ss.home_lat, ss.home_lon = HOME_LAT, HOME_LON
 
@@ -100,10 +249,14 @@ with st.sidebar.expander("Shelters data", expanded=True):
     up = st.file_uploader("Upload shelters.csv (name,lat,lon[,type,capacity])", type=["csv"])
     if up is not None:
         try:
-            ss.shelters = load_shelters_from_csv(up)
+            if up.file_id != ss.get("upload_id"):  # only re-index a newly selected file
+                set_shelters(load_shelters_from_csv(up.getvalue()))
+                ss.upload_id = up.file_id
             st.success(f"Loaded {len(ss.shelters)} shelters from uploaded CSV.")
         except Exception as e:
             st.error(f"CSV error: {e}")
+    if ss.shelters_dropped:
+        st.warning(f"Skipped {ss.shelters_dropped} row(s) with missing or out-of-range lat/lon.")
 
 radius_km = st.sidebar.slider("Focus radius (km)", 1, 10, 3, step=1)
 
@@ -128,21 +281,29 @@ state, elapsed, remain = state_at(ss.tick)
 is_alert = (state == "ALERT")
 
 home_lat, home_lon = ss.home_lat, ss.home_lon
-df_s = ss.shelters.copy()
-df_s["dist_km"] = df_s.apply(lambda r: haversine_km(home_lat, home_lon, r["lat"], r["lon"]), axis=1)
-df_s["eta_min"] = (df_s["dist_km"] * 12).clip(lower=1).round().astype(int)  # walk ~5 km/h
+top_idx, top_dist, top_eta = nearest_shelters(home_lat, home_lon, radius_km, ss.shelters_key,
+                                              ss.shelter_lat_ideg, ss.shelter_lon_ideg)
 
-# Filter to focus radius
-df_focus = df_s[df_s["dist_km"] <= radius_km].sort_values("dist_km")
-top2 = df_focus.head(2) if not df_focus.empty else df_s.nsmallest(2, "dist_km")
+# Two nearest within the focus radius (falls back to overall nearest)
+top2 = ss.shelters.iloc[top_idx].assign(dist_km=top_dist, eta_min=top_eta)
 
 # ----------------------------
 # Layout
 # ----------------------------
 colA, colB = st.columns([1,3])
 
-# ---- Status & guidance
-with colA:
+# ---- Status & guidance (reruns on its own every tick; the map only reruns on input)
+# While stopped there is nothing to advance, so no timed reruns are scheduled at all.
+@st.fragment(run_every=TICK_SECONDS if ss.running else None)
+def status_panel(top2, plan_rows, plan_csv, radius_km, home_lat, home_lon):
+    if ss.running and ss.tick_armed:
+        ss.tick += 1
+    ss.tick_armed = True
+    state, elapsed, remain = state_at(ss.tick)
+    is_alert = (state == "ALERT")
+    if is_alert != ss.map_alert:
+        st.rerun()  # ALERT/SAFE flipped: redraw the map colours as well
+
     st.markdown("### Status (Vyshhorod)")
     if is_alert:
         st.markdown(
@@ -162,12 +323,10 @@ with colA:
     if top2.empty:
         st.warning("No shelters within radius. Increase the radius or upload a CSV.")
     else:
-        for _, srow in top2.iterrows():
-            extra = []
-            if "type" in srow and not pd.isna(srow["type"]):      extra.append(str(srow["type"]))
-            if "capacity" in srow and not pd.isna(srow["capacity"]): extra.append(f"cap {int(srow['capacity'])}")
-            extra_txt = f" • {' • '.join(extra)}" if extra else ""
-            st.write(f"**{srow['name']}** — {srow['dist_km']:.2f} km • ~{srow['eta_min']} min walk{extra_txt}")
+        rows = zip(top2["name"].to_numpy(), top2["dist_km"].to_numpy(),
+                   top2["eta_min"].to_numpy(), extra_text(top2))
+        for name, dist_km, eta_min, extra_txt in rows:
+            st.write(f"**{name}** — {dist_km:.2f} km • ~{eta_min} min walk{extra_txt}")
 
     # Download "My Plan"
     if not top2.empty:
@@ -177,82 +336,20 @@ with colA:
             f"Status: {'ALERT' if is_alert else 'SAFE'} (remain {remain}s)",
             "",
         ]
-        for i, (_, r) in enumerate(top2.iterrows(), start=1):
-            plan_lines.append(f"{i}. {r['name']} — {r['dist_km']:.2f} km (~{r['eta_min']} min)")
-        txt = "\n".join(plan_lines)
+        txt = "\n".join(plan_lines + [plan_rows])
         st.download_button("📄 Download My Plan (TXT)", data=txt.encode("utf-8"),
-                           file_name="vyshhorod_shelter_plan.txt", mime="text/plain")
+                           file_name="vyshhorod_shelter_plan.txt", mime="text/plain", on_click="ignore")
 
-        csv_bytes = top2[["name","lat","lon","dist_km","eta_min"] + [c for c in ["type","capacity"] if c in top2.columns]] \
-                        .to_csv(index=False).encode("utf-8")
-        st.download_button("📥 Download My Plan (CSV)", data=csv_bytes,
-                           file_name="vyshhorod_shelter_plan.csv", mime="text/csv")
+        st.download_button("📥 Download My Plan (CSV)", data=plan_csv,
+                           file_name="vyshhorod_shelter_plan.csv", mime="text/csv", on_click="ignore")
+
+ss.tick_armed = False  # a full run renders the current tick; later fragment runs advance it
+ss.map_alert = is_alert
+plan_rows, plan_csv = plan_blobs(home_lat, home_lon, tuple(top_idx.tolist()), ss.shelters_key, top2)
+with colA:
+    status_panel(top2, plan_rows, plan_csv, radius_km, home_lat, home_lon)
 
 # ---- Map (fixed)
 with colB:
-    # Layers: home, shelters, highlights, paths, focus ring
-    home_layer = pdk.Layer(
-        "ScatterplotLayer",
-        data=[{"name":"You","lat":home_lat,"lon":home_lon}],
-        get_position='[lon, lat]',
-        get_radius=60,
-        get_fill_color='[200, 30, 30]' if is_alert else '[30, 160, 60]',
-        pickable=True,
-    )
-
-    shelter_layer = pdk.Layer(
-        "ScatterplotLayer",
-        data=df_s[["name","lat","lon"]].to_dict("records"),
-        get_position='[lon, lat]',
-        get_radius=50,
-        get_fill_color='[30, 120, 200]',
-        pickable=True,
-    )
-
-    highlight_layer = pdk.Layer(
-        "ScatterplotLayer",
-        data=top2[["name","lat","lon"]].to_dict("records"),
-        get_position='[lon, lat]',
-        get_radius=85,
-        get_fill_color='[240, 180, 0]',
-        pickable=True,
-    )
-
-    paths = [{"path":[[home_lon, home_lat],[r["lon"], r["lat"]]], "name":f"→ {r['name']}"}
-             for _, r in top2.iterrows()]
-    path_layer = pdk.Layer(
-        "PathLayer",
-        data=paths,
-        get_path="path",
-        width_scale=2,
-        get_width=5,
-        get_color=[255, 140, 0] if is_alert else [120,120,120],
-        pickable=True,
-    )
-
-    focus_ring = pdk.Layer(
-        "ScatterplotLayer",
-        data=[{"lat": HOME_LAT, "lon": HOME_LON, "name":"Vyshhorod"}],
-        get_position='[lon, lat]',
-        get_radius=int(radius_km*320),  # rough visual radius
-        get_fill_color='[30,160,60,30]',
-        pickable=False,
-    )
-
-    deck = pdk.Deck(
-        map_provider="carto",      # <= free tiles, no token needed
-        map_style="dark",
-        initial_view_state=pdk.ViewState(latitude=HOME_LAT, longitude=HOME_LON, zoom=12.2),
-        layers=[focus_ring, shelter_layer, highlight_layer, path_layer, home_layer],
-        tooltip={"text": "{name}"},
-    )
-
+    deck = session_deck(home_lat, home_lon, tuple(top_idx.tolist()), is_alert, radius_km, top2)
     st.pydeck_chart(deck, use_container_width=True, height=520)
-
-# ----------------------------
-# Auto-tick & rerun
-# ----------------------------
-if ss.running:
-    time.sleep(TICK_SECONDS)
-    ss.tick += 1
-    st.rerun()
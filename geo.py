@@ -0,0 +1,18 @@
+"""Numba-compiled geo kernels.
+
+Kept out of app.py: Streamlit re-executes the script on every rerun, which would
+create a fresh dispatcher (and reload the compiled code) each time.
+"""
+import math
+from numba import njit
+
+
+@njit(cache=True, fastmath=True)
+def haversine_km_from_home(p1, cos_p1, lmb1, lat2, lon2):
+    """Great-circle distance (km) from a home point given as p1, lmb1 in radians and cos_p1 = cos(p1)."""
+    R = 6371.0
+    p2 = math.radians(lat2)
+    dphi = p2 - p1
+    dlmb = math.radians(lon2) - lmb1
+    a = math.sin(dphi/2)**2 + cos_p1*math.cos(p2)*math.sin(dlmb/2)**2
+    return 2*R*math.asin(math.sqrt(a))